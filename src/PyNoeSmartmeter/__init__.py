@@ -2,11 +2,11 @@
 
 from importlib.metadata import version
 
-from .client import Smartmeter
+from .client import ConsumptionSeries, Smartmeter
 
 try:
     __version__ = version(__name__)
 except Exception:
     pass
 
-__all__ = ["Smartmeter"]
+__all__ = ["ConsumptionSeries", "Smartmeter"]
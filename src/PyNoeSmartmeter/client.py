@@ -2,18 +2,49 @@
 
 import logging
 
+import asyncio
+import contextlib
 import datetime
-import os
-import pickle
+import random
+import time
+from typing import NamedTuple
 import httpx
 import aiofiles
+from aiofiles import os as aio_os
+import msgpack
+import orjson
 
 
-from .errors import SmartmeterLoginError, SmartmeterConnectionError
+from .errors import SmartmeterError, SmartmeterLoginError, SmartmeterConnectionError
 
 logger = logging.getLogger(__name__)
 
 
+class ConsumptionSeries(NamedTuple):
+    """Consumption values and their timestamps as parallel lists."""
+
+    times: list
+    values: list
+
+
+def _sum_values(values):
+    """Sum consumption values, skipping missing (None) entries."""
+    # filter(None, ...) also drops zeros, which do not change the sum
+    return sum(filter(None, values))
+
+
+async def _gather(*coroutines):
+    """Run coroutines concurrently, cancelling the rest if one of them fails."""
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
 class Smartmeter:
     """Smartmeter client."""
 
@@ -25,102 +56,282 @@ class Smartmeter:
     API_METER_DETAILS_URL = API_BASE_URL + "/User/GetMeteringPointByAccountId"
 
     API_CONSUMPTION_URL = API_BASE_URL + "/ConsumptionRecord"
+    API_CONSUMPTION_DAY_URL = API_CONSUMPTION_URL + "/Day"
+    API_CONSUMPTION_MONTH_URL = API_CONSUMPTION_URL + "/Month"
+    API_CONSUMPTION_YEAR_URL = API_CONSUMPTION_URL + "/Year"
+
+    _USER_DETAILS_URL_CTX2 = API_USER_DETAILS_URL + "?context=2"
+    _ACCOUNTING_DETAILS_URL_CTX2 = API_ACCOUNTING_DETAILS_URL + "?context=2"
+
+    MAX_ATTEMPTS = 4
+    DETAILS_TTL = 24 * 60 * 60
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
 
-    SESSION_FILE = "noe_smartmeter_session_httpx.pkl"
+    SESSION_FILE = "noe_smartmeter_session_httpx.msgpack"
+    LEGACY_SESSION_FILE = "noe_smartmeter_session_httpx.pkl"
 
     def __init__(self, username, password):
         """Access the Smartmeter API."""
         self.supports_api = False
         self._metering_point_id = None
         self._account_id = None
-        self._session = None
+        self._accounting_details = None
+        self._accounting_details_time = 0
+        self._meter_details = None
+        self._meter_details_time = 0
+        self._authenticated = False
+        self._fresh_login = False
+        self._login_generation = 0
+        self._login_lock = asyncio.Lock()
+        self._login_task = None
+        self._session = httpx.AsyncClient(
+            http2=True,
+            headers={"accept": "application/json"},
+            timeout=30.0,
+            limits=httpx.Limits(
+                max_keepalive_connections=4, max_connections=4, keepalive_expiry=60
+            ),
+        )
         self._username = username
         self._password = password
 
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """Close the underlying HTTP connection pool."""
+        await self._session.aclose()
+
     async def authenticate(self, username = None, password = None):
         """Load session file or authenticate user."""
         if username is not None:
             self._username = username
+            self._clear_account()
             await self._clear_stored_session()
         if password is not None:
             self._password = password
             await self._clear_stored_session()
 
-        if await self._load_check_session():
-           return True
+        await self._authenticate(force=True)
+        return True
 
-        print("Starting new session and authenticate")
-        session = httpx.AsyncClient(timeout=30.0)
+    async def _authenticate(self, force=False):
+        async with self._login_guard():
+            # Another task may have authenticated while this one waited
+            if self._authenticated and not force:
+                return
+            if await self._load_check_session():
+                return
+
+            await self._login(save_session=False)
+
+            # Resolve account and meter now so the first consumption call skips them
+            try:
+                await self.get_meter_details()
+            except (
+                SmartmeterError,
+                httpx.RequestError,
+                LookupError,
+                ValueError,
+            ) as error:
+                logger.warning("Could not load meter details: %s", error)
+            await self._save_session()
+
+    @contextlib.asynccontextmanager
+    async def _login_guard(self):
+        # Calls made while logging in (the meter prefetch) may log in again
+        # themselves, so the task holding the lock is let through
+        if self._login_task is asyncio.current_task():
+            yield
+            return
+        async with self._login_lock:
+            self._login_task = asyncio.current_task()
+            try:
+                yield
+            finally:
+                self._login_task = None
+
+    async def _login(self, save_session=True):
+        logger.debug("Starting new session and authenticate")
         auth_data = {"user": self._username, "pwd": self._password}
-        response = await session.post(self.AUTH_URL, data=auth_data)
+        response = await self._session.post(self.AUTH_URL, data=auth_data)
 
         if response.status_code == 200:
-            print("Authentication sucessful")
+            logger.info("Authentication successful")
         elif response.status_code == 401:
             raise SmartmeterLoginError("Login failed. Check username/password.")
         else:
             raise SmartmeterConnectionError(
                 f"Authentication failed with status {response.status_code}"
             )
-        await self._save_session(session)
-        
-        self._session = session
-        return True
+        # Swap in the new cookies at once, requests in flight keep their own
+        self._session.cookies = response.cookies
+        self._login_generation += 1
+        self._authenticated = True
+        # Stays set until a request succeeds with the new session
+        self._fresh_login = True
+        if save_session:
+            await self._save_session()
+
+    def _clear_account(self):
+        self.supports_api = False
+        self._account_id = None
+        self._metering_point_id = None
+        self._accounting_details = None
+        self._accounting_details_time = 0
+        self._meter_details = None
+        self._meter_details_time = 0
 
-    async def _check_session(self, session):
+    def _is_fresh(self, fetched_at):
+        return fetched_at > 0 and time.monotonic() - fetched_at < self.DETAILS_TTL
+
+    async def _check_session(self):
         try:
-            response = await session.get(self.API_USER_DETAILS_URL)
+            response = await self._session.get(self.API_USER_DETAILS_URL)
             return response.status_code == 200
-        except (TypeError) as error:
-            print(error)
+        except TypeError:
+            logger.exception("Checking the stored session failed")
             return False
 
-    async def _save_session(self, session):
-        serialized_data = pickle.dumps(dict(session.cookies))
+    async def _save_session(self):
+        serialized_data = msgpack.packb(
+            {
+                "cookies": {
+                    key: value for key, value in self._session.cookies.items()
+                },
+                "supports_api": self.supports_api,
+                "account_id": self._account_id,
+                "metering_point_id": self._metering_point_id,
+            },
+            use_bin_type=True,
+        )
         async with aiofiles.open(self.SESSION_FILE, "wb") as f:
             await f.write(serialized_data)
     
     async def _load_check_session(self):
         # Check if a cached session exists
-        print("Checking stored session")
-        if os.path.exists(self.SESSION_FILE):
+        logger.debug("Checking stored session")
+        stored = await self._read_stored_session()
+        if stored is not None:
+            self._session.cookies.update(stored.get("cookies", {}))
+            if await self._check_session():
+                logger.debug("Stored session is valid")
+                self.supports_api = stored.get("supports_api", False)
+                self._account_id = stored.get("account_id")
+                self._metering_point_id = stored.get("metering_point_id")
+                self._authenticated = True
+                return True
+        logger.debug("Session is not stored or invalid")
+        return False
+
+    async def _read_stored_session(self):
+        try:
             async with aiofiles.open(self.SESSION_FILE, "rb") as f:
                 data = await f.read()
-                cookies = pickle.loads(data)
-                session = httpx.AsyncClient(timeout=30.0, cookies=cookies)
-                if await self._check_session(session):
-                    print("Stored session is valid")
-                    self._session = session
-                    return True           
-        print("Session is not stored or invalid!")                
-        return False
+        except FileNotFoundError:
+            # Never unpickle a legacy session file, just drop it and log in again
+            with contextlib.suppress(FileNotFoundError):
+                await aio_os.remove(self.LEGACY_SESSION_FILE)
+            return None
+        try:
+            stored = msgpack.unpackb(data, raw=False, strict_map_key=False)
+        except (ValueError, msgpack.UnpackException):
+            stored = None
+        if not isinstance(stored, dict) or not isinstance(
+            stored.get("cookies", {}), dict
+        ):
+            logger.warning("Stored session is corrupt, removing it")
+            await self._clear_stored_session()
+            return None
+        return stored
 
     async def _clear_stored_session(self):
-        if os.path.exists(self.SESSION_FILE):
-            os.remove(self.SESSION_FILE)
-            print("Stored session deleted successfully.")
+        with contextlib.suppress(FileNotFoundError):
+            await aio_os.remove(self.SESSION_FILE)
+            logger.debug("Stored session deleted successfully")
 
     async def _call_api(self, url, params=None):
-        if self._session is None:
-            await self.authenticate()
-        retry_count = 0
-        while retry_count < 1:
-            response = await self._session.get(url, params=params)
-            if response.status_code == 401:
-                await self.authenticate()
-                retry_count += 1
-            elif response.status_code == 200:
+        if not self._authenticated:
+            await self._authenticate()
+        last_error = None
+        for attempt in range(self.MAX_ATTEMPTS):
+            generation = self._login_generation
+            try:
+                response = await self._session.get(url, params=params)
+            except httpx.TransportError as error:
+                logger.debug("Request to %s failed: %s", url, error)
+                last_error = error
+                await self._wait_before_retry(attempt)
+                continue
+            logger.debug("%s answered with %s", url, response.http_version)
+            if response.status_code == 200:
+                self._fresh_login = False
                 return response
+            if response.status_code == 401:
+                await self._relogin(generation)
+                continue
+            if response.status_code in self.RETRY_STATUS_CODES:
+                last_error = SmartmeterConnectionError(
+                    f"API call failed with status {response.status_code}",
+                    code=response.status_code,
+                    error_response=response.text,
+                )
+                await self._wait_before_retry(attempt)
+                continue
+            raise SmartmeterConnectionError(
+                f"API call failed with status {response.status_code}",
+                code=response.status_code,
+                error_response=response.text,
+            )
+        raise SmartmeterConnectionError(
+            f"API call to {url} failed after {self.MAX_ATTEMPTS} attempts",
+            code=getattr(last_error, "code", None),
+            error_response=getattr(last_error, "error_response", ""),
+        ) from last_error
+
+    async def _relogin(self, generation):
+        # Concurrent requests share one login, the stored session is skipped
+        async with self._login_guard():
+            if generation != self._login_generation:
+                return
+            if self._fresh_login:
+                raise SmartmeterLoginError("API call rejected right after a new login.")
+            await self._login()
+
+    async def _wait_before_retry(self, attempt):
+        # No point in waiting once the last attempt has failed
+        if attempt < self.MAX_ATTEMPTS - 1:
+            await asyncio.sleep(self._backoff(attempt))
+
+    @staticmethod
+    def _backoff(attempt):
+        return 2**attempt * 0.2 + random.random() * 0.1
+
+    @staticmethod
+    def _parse(response):
+        return orjson.loads(response.content)
+
+    async def _ensure_metering_point(self):
+        # Authenticate first, a stored session already carries the meter id
+        if not self._authenticated:
+            await self._authenticate()
+        if self._metering_point_id is None:
+            await self.get_meter_details()
 
     async def get_user_details(self):
         """Load user details"""
-        response = await self._call_api(self.API_USER_DETAILS_URL + "?context=2")
-        return response.json()[0]
+        response = await self._call_api(self._USER_DETAILS_URL_CTX2)
+        return self._parse(response)[0]
 
     async def get_accounting_details(self):
         """Load accounting details"""
-        response = await self._call_api(self.API_ACCOUNTING_DETAILS_URL + "?context=2")
-        entry = response.json()[0]
+        if self._is_fresh(self._accounting_details_time):
+            return self._accounting_details
+        response = await self._call_api(self._ACCOUNTING_DETAILS_URL_CTX2)
+        entry = self._parse(response)[0]
 
         has_smartmeter = entry["hasSmartMeter"]
         has_electricity = entry["hasElectricity"]
@@ -131,82 +342,63 @@ class Smartmeter:
         )
 
         self._account_id = entry["accountId"]
+        self._accounting_details = entry
+        self._accounting_details_time = time.monotonic()
         return entry
 
     async def get_meter_details(self):
         """Load meter details"""
+        if self._is_fresh(self._meter_details_time):
+            return self._meter_details
         if self._account_id is None:
             await self.get_accounting_details()
         response = await self._call_api(
-            self.API_METER_DETAILS_URL
-            + "?context=2&accountId="
-            + (self._account_id or "")
+            self.API_METER_DETAILS_URL,
+            params=(("context", 2), ("accountId", self._account_id or "")),
         )
-        entry = response.json()[0]
+        entry = self._parse(response)[0]
 
         self._metering_point_id = entry["meteringPointId"]
+        self._meter_details = entry
+        self._meter_details_time = time.monotonic()
 
         return entry
 
-    async def get_consumption_per_day(self, day):
-        """Load consumption for one day"""
-        print(f"Load consumption for day {day}")
-        if self._metering_point_id is None:
-            await self.get_meter_details()
+    async def _fetch_consumption(self, url, value_key, *params):
+        await self._ensure_metering_point()
         try:
             response = await self._call_api(
-                self.API_CONSUMPTION_URL + "/Day",
-                params={"meterId": self._metering_point_id, "day": day},
-            )
-            data = response.json()[0]
-            consumption_per_day = list(
-                zip(data["peakDemandTimes"], data["meteredValues"])
+                url, params=(("meterId", self._metering_point_id), *params)
             )
-            return consumption_per_day
-        except (httpx.RequestError, ValueError) as error:
-            print(f"An error occurred: {error}")
-            return []
+            data = self._parse(response)[0]
+            return ConsumptionSeries(data["peakDemandTimes"], data[value_key])
+        except (SmartmeterConnectionError, httpx.RequestError, ValueError) as error:
+            logger.error("An error occurred: %s", error)
+            return ConsumptionSeries([], [])
+
+    async def get_consumption_per_day(self, day):
+        """Load consumption for one day"""
+        logger.debug("Load consumption for day %s", day)
+        return await self._fetch_consumption(
+            self.API_CONSUMPTION_DAY_URL, "meteredValues", ("day", day)
+        )
 
     async def get_consumption_for_month(self, year, month):
         """Load consumption for one month"""
-        print(f"Load consumption for month {month}/{year}")
-        if self._metering_point_id is None:
-            await self.get_meter_details()
-        try:
-            response = await self._call_api(
-                self.API_CONSUMPTION_URL + "/Month",
-                params={
-                    "meterId": self._metering_point_id,
-                    "year": year,
-                    "month": month,
-                },
-            )
-            data = response.json()[0]
-            consumption_for_month = list(
-                zip(data["peakDemandTimes"], data["meteredValues"])
-            )
-            return consumption_for_month
-        except (httpx.RequestError, ValueError) as error:
-            print(f"An error occurred: {error}")
-            return []
+        logger.debug("Load consumption for month %s/%s", month, year)
+        return await self._fetch_consumption(
+            self.API_CONSUMPTION_MONTH_URL,
+            "meteredValues",
+            ("year", year),
+            ("month", month),
+        )
 
     async def get_consumption_for_year(self, year):
         """Load consumption for one year"""
-        print("Load consumption for year:", year)
-        if self._metering_point_id is None:
-            await self.get_meter_details()
-        try:
-            response = await self._call_api(
-                self.API_CONSUMPTION_URL + "/Year",
-                params={"meterId": self._metering_point_id, "year": year},
-            )
-            response.raise_for_status()  # Raise an exception if the response contains an HTTP error status code
-            data = response.json()[0]
-            consumption_for_year = list(zip(data["peakDemandTimes"], data["values"]))
-            return consumption_for_year
-        except (httpx.RequestError, ValueError) as error:
-            print(f"An error occurred: {error}")
-            return []
+        logger.debug("Load consumption for year %s", year)
+        return await self._fetch_consumption(
+            self.API_CONSUMPTION_YEAR_URL, "values", ("year", year)
+        )
 
     async def get_consumption_since_date(self, input_date_string, offset):
         """Load consumption since a specific datetime and adds the offset"""
@@ -215,49 +407,60 @@ class Smartmeter:
         energy_sum = 0
 
         if current_date == input_date.date():
-            print("The current date is to new. Returning input!")
+            logger.debug("The current date is too new, returning input")
             return {"timestamp": input_date_string, "consumption": offset}
 
-        # Add up day consumption after input time (hours)
-        day_data = await self.get_consumption_per_day(input_date.strftime("%Y-%m-%d"))
-        for time, consumption in day_data:
-            formatted_time = datetime.datetime.strptime(time, "%Y-%m-%dT%H:%M:%S")
-            if formatted_time > input_date:
-                energy_sum += consumption
+        await self._ensure_metering_point()
 
-        # Add up the rest of the month consumption after input date (days)
-        month_data = await self.get_consumption_for_month(
-            input_date.year, input_date.month
-        )
-        energy_sum += sum(
-            value[1] for value in month_data[input_date.day :] if value[1] is not None
-        )
-
-        # Add up the rest of the year consumption after input date (months)
+        # Only request the month and year if the rest of them is not empty
+        next_day = input_date + datetime.timedelta(days=1)
+        fetch_month = next_day.month == input_date.month
         start_index = input_date.month
         end_index = 12
         if input_date.year == current_date.year:
             end_index = current_date.month - 1
-        year_data = await self.get_consumption_for_year(input_date.year)
-        energy_sum += sum(
-            value[1]
-            for value in year_data[start_index:end_index]
-            if value[1] is not None
+        fetch_year = start_index < end_index
+
+        # The day, month and year requests are independent, fetch them concurrently
+        requests = {
+            "day": self.get_consumption_per_day(input_date.strftime("%Y-%m-%d"))
+        }
+        if fetch_month:
+            requests["month"] = self.get_consumption_for_month(
+                input_date.year, input_date.month
+            )
+        if fetch_year:
+            requests["year"] = self.get_consumption_for_year(input_date.year)
+        for year in range(input_date.year + 1, current_date.year + 1):
+            requests[year] = self.get_consumption_for_year(year)
+        results = dict(zip(requests, await _gather(*requests.values())))
+        day_data = results.pop("day")
+        month_data = results.pop("month", None)
+        year_data = results.pop("year", None)
+        later_years = results.values()
+
+        # Add up day consumption after input time (hours)
+        # The timestamps are fixed-width ISO 8601, so string order is time order
+        cutoff = input_date.strftime("%Y-%m-%dT%H:%M:%S")
+        energy_sum += _sum_values(
+            value
+            for timestamp, value in zip(day_data.times, day_data.values)
+            if timestamp[:19] > cutoff
         )
 
+        # Add up the rest of the month consumption after input date (days)
+        if month_data is not None:
+            energy_sum += _sum_values(month_data.values[input_date.day :])
+
+        # Add up the rest of the year consumption after input date (months)
+        if year_data is not None:
+            energy_sum += _sum_values(year_data.values[start_index:end_index])
+
         # Add up the rest of the time after the input dates year (months)
-        if input_date.year != current_date.year:
-            start_year = (
-                input_date.year + 1
-                if input_date.year + 1 <= current_date.year
-                else input_date.year
-            )
-            for year in range(start_year, current_date.year + 1):
-                year_values = await self.get_consumption_for_year(year)
-                energy_sum += sum(
-                    value[1] for value in year_values if value[1] is not None
-                )
+        for year_values in later_years:
+            energy_sum += _sum_values(year_values.values)
 
         # It is assumed that the last datapoint is from the current date at 00:00 since the smartmeter only transmits data once a day
-        print(f"Consumption until {current_date.strftime("%d.%m.%Y %H:%M")}: {energy_sum + offset}")
-        return {"timestamp": current_date.strftime("%d.%m.%Y %H:%M"), "consumption": energy_sum + offset}
+        timestamp = current_date.strftime("%d.%m.%Y %H:%M")
+        logger.debug("Consumption until %s: %s", timestamp, energy_sum + offset)
+        return {"timestamp": timestamp, "consumption": energy_sum + offset}
@@ -0,0 +1,328 @@
+"""Tests for the Smartmeter API client."""
+
+import asyncio
+import datetime
+import inspect
+
+import httpx
+import orjson
+import pytest
+
+from PyNoeSmartmeter import Smartmeter
+from PyNoeSmartmeter.errors import SmartmeterConnectionError, SmartmeterLoginError
+
+USER = {"name": "user"}
+ACCOUNTING = {
+    "hasSmartMeter": True,
+    "hasElectricity": True,
+    "hasCommunicative": True,
+    "hasActive": True,
+    "accountId": "A1",
+}
+METER = {"meteringPointId": "M1"}
+
+
+def json_response(data, status_code=200):
+    return httpx.Response(status_code, content=orjson.dumps(data))
+
+
+def status(status_code):
+    return lambda request: httpx.Response(status_code)
+
+
+def consumption(times, values, value_key="meteredValues"):
+    data = [{"peakDemandTimes": times, value_key: values}]
+    return lambda request: json_response(data)
+
+
+class FakeApi:
+    """Answers every endpoint the client uses, tests override single routes."""
+
+    def __init__(self, **routes):
+        self.requests = []
+        self.routes = {
+            "Login": self.login,
+            "GetBasicInfo": lambda request: json_response([USER]),
+            "GetAccountIdByBussinespartnerId": lambda request: json_response(
+                [ACCOUNTING]
+            ),
+            "GetMeteringPointByAccountId": lambda request: json_response([METER]),
+            "Day": consumption([], []),
+            "Month": consumption([], []),
+            "Year": consumption([], [], "values"),
+        }
+        self.routes.update(routes)
+
+    @property
+    def paths(self):
+        return [request.url.path.rsplit("/", 1)[1] for request in self.requests]
+
+    def login(self, request):
+        logins = self.paths.count("Login")
+        return httpx.Response(200, headers={"set-cookie": f"sid={logins}; Path=/"})
+
+    async def __call__(self, request):
+        self.requests.append(request)
+        response = self.routes[request.url.path.rsplit("/", 1)[1]](request)
+        if inspect.isawaitable(response):
+            response = await response
+        return response
+
+
+def make_client(api):
+    client = Smartmeter("user", "password")
+    client._session = httpx.AsyncClient(transport=httpx.MockTransport(api))
+    return client
+
+
+def run(api, call):
+    async def main():
+        async with make_client(api) as client:
+            return await call(client)
+
+    return asyncio.run(main())
+
+
+@pytest.fixture(autouse=True)
+def isolate(tmp_path, monkeypatch):
+    """Keep session files out of the repo and skip retry delays."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(Smartmeter, "_backoff", staticmethod(lambda attempt: 0))
+
+
+def test_call_api_retries_server_errors():
+    statuses = iter([503, 500, 200])
+    api = FakeApi(GetBasicInfo=lambda request: json_response([USER], next(statuses)))
+
+    assert run(api, lambda client: client.get_user_details()) == USER
+
+
+def test_call_api_gives_up_after_max_attempts(monkeypatch):
+    backoffs = []
+    monkeypatch.setattr(
+        Smartmeter, "_backoff", staticmethod(lambda attempt: backoffs.append(0) or 0)
+    )
+    api = FakeApi(GetBasicInfo=status(503))
+
+    with pytest.raises(SmartmeterConnectionError) as error:
+        run(api, lambda client: client.get_user_details())
+    assert api.paths.count("GetBasicInfo") == Smartmeter.MAX_ATTEMPTS
+    # No backoff after the final attempt, and the last failure is kept
+    assert len(backoffs) == Smartmeter.MAX_ATTEMPTS - 1
+    assert error.value.code == 503
+    assert error.value.__cause__ is not None
+
+
+def test_call_api_keeps_transport_error_as_cause():
+    def unreachable(request):
+        raise httpx.ConnectError("unreachable")
+
+    api = FakeApi(GetBasicInfo=unreachable)
+
+    with pytest.raises(SmartmeterConnectionError) as error:
+        run(api, lambda client: client.get_user_details())
+    assert isinstance(error.value.__cause__, httpx.ConnectError)
+
+
+def test_failed_consumption_request_returns_empty_series():
+    api = FakeApi(Year=status(404))
+
+    assert run(api, lambda client: client.get_consumption_for_year(2024)) == ([], [])
+
+
+def test_stored_session_is_restored_without_lookups():
+    def check_cookie(request):
+        if request.headers.get("cookie") != "sid=1":
+            return httpx.Response(401)
+        return json_response([USER])
+
+    run(FakeApi(), lambda client: client.authenticate())
+
+    async def restore(client):
+        await client.authenticate()
+        await client.get_consumption_for_year(2024)
+        return client
+
+    api = FakeApi(GetBasicInfo=check_cookie)
+    client = run(api, restore)
+    assert api.paths == ["GetBasicInfo", "Year"]
+    assert client.supports_api is True
+    assert client._account_id == "A1"
+    assert client._metering_point_id == "M1"
+    assert api.requests[-1].url.params["meterId"] == "M1"
+
+
+@pytest.mark.parametrize("content", [b"", b"\x82\xa7cookies", b"\x91\x01"])
+def test_corrupt_session_file_is_removed(content):
+    with open(Smartmeter.SESSION_FILE, "wb") as f:
+        f.write(content)
+
+    assert run(FakeApi(), lambda client: client.authenticate())
+    with open(Smartmeter.SESSION_FILE, "rb") as f:
+        assert f.read() != content
+
+
+def test_missing_meter_does_not_fail_authentication():
+    api = FakeApi(GetMeteringPointByAccountId=lambda request: json_response([]))
+
+    assert run(api, lambda client: client.get_user_details()) == USER
+
+
+def test_meter_details_are_cached():
+    async def call(client):
+        await client.authenticate()
+        await client.get_meter_details()
+        await client.get_accounting_details()
+
+    api = FakeApi()
+    run(api, call)
+    assert api.paths == [
+        "Login",
+        "GetAccountIdByBussinespartnerId",
+        "GetMeteringPointByAccountId",
+    ]
+
+
+def test_failing_consumption_request_cancels_the_others():
+    cancelled = []
+
+    async def hang(request):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(request.url.path)
+            raise
+        return json_response([])
+
+    api = FakeApi(
+        Day=lambda request: json_response([{"unexpected": []}]), Month=hang, Year=hang
+    )
+
+    with pytest.raises(KeyError):
+        run(
+            api,
+            lambda client: client.get_consumption_since_date("24.03.2024 10:03", 0),
+        )
+    assert cancelled
+
+
+def test_relogin_once_on_expired_session():
+    statuses = iter([401])
+
+    def expire_once(request):
+        return json_response([USER], next(statuses, 200))
+
+    async def call(client):
+        await client.authenticate()
+        return await client.get_user_details()
+
+    api = FakeApi(GetBasicInfo=expire_once)
+    assert run(api, call) == USER
+    assert api.paths.count("Login") == 2
+
+
+def test_401_after_fresh_login_raises_login_error():
+    api = FakeApi(
+        GetBasicInfo=status(401),
+        GetAccountIdByBussinespartnerId=status(401),
+    )
+
+    with pytest.raises(SmartmeterLoginError):
+        run(api, lambda client: client.get_user_details())
+    assert api.paths.count("Login") == 1
+
+
+def test_401_during_meter_prefetch_does_not_recurse():
+    api = FakeApi(GetAccountIdByBussinespartnerId=status(401))
+
+    assert run(api, lambda client: client.get_user_details()) == USER
+    assert api.paths.count("Login") == 1
+
+
+class ExpiringApi(FakeApi):
+    """Only accepts the cookie of the latest login and answers slowly."""
+
+    valid_cookie = None
+
+    async def __call__(self, request):
+        await asyncio.sleep(0.01)
+        is_login = request.url.path.endswith("/Login")
+        if not is_login and request.headers.get("cookie") != self.valid_cookie:
+            self.requests.append(request)
+            return httpx.Response(401)
+        return await super().__call__(request)
+
+    def login(self, request):
+        response = super().login(request)
+        self.valid_cookie = response.headers["set-cookie"].split(";")[0]
+        return response
+
+
+def test_concurrent_401s_share_one_login():
+    async def call(client):
+        await client.authenticate()
+        # Let the server expire the session
+        api.valid_cookie = None
+        return await client.get_consumption_since_date("24.03.2024 10:03", 0)
+
+    api = ExpiringApi(Year=consumption([], [1] * 12, "values"))
+    result = run(api, call)
+    assert api.paths.count("Login") == 2
+    assert result["consumption"] > 0
+
+
+def test_empty_month_and_year_slices_are_not_requested():
+    api = FakeApi(Year=consumption([], [1] * 12, "values"))
+
+    run(api, lambda client: client.get_consumption_since_date("31.12.2023 10:03", 0))
+    assert "Month" not in api.paths
+    # Only the years after 2023 are requested
+    assert api.paths.count("Year") == datetime.date.today().year - 2023
+
+
+def test_fresh_login_writes_the_session_file_once(monkeypatch):
+    saves = []
+    save_session = Smartmeter._save_session
+
+    async def counting_save(self):
+        saves.append(self._metering_point_id)
+        await save_session(self)
+
+    monkeypatch.setattr(Smartmeter, "_save_session", counting_save)
+    run(FakeApi(), lambda client: client.authenticate())
+    assert saves == ["M1"]
+
+
+def test_day_consumption_counts_rows_after_the_input_time():
+    times = [
+        "2023-10-29T02:15:00",
+        "2023-10-29T01:00:00",
+        "2023-10-29T02:15:00",
+        "2023-10-29T02:00:00",
+        "2023-10-29T02:30:00Z",
+        "2023-10-29T03:00:00",
+        "2023-10-29T04:00:00",
+    ]
+    values = [1, 2, 4, None, 8, 16, 32]
+    api = FakeApi(Day=consumption(times, values))
+
+    result = run(
+        api, lambda client: client.get_consumption_since_date("29.10.2023 02:00", 0)
+    )
+    assert api.paths.count("Month") == 1
+    # Rows before and at 02:00 are skipped, None is ignored, order does not matter
+    assert result["consumption"] == 1 + 4 + 8 + 16 + 32
+
+
+def test_concurrent_first_calls_share_one_login():
+    async def call(client):
+        return await asyncio.gather(
+            *(client.get_consumption_for_year(year) for year in (2022, 2023, 2024))
+        )
+
+    api = ExpiringApi()
+    run(api, call)
+    assert api.paths.count("Login") == 1
+    assert api.paths.count("GetAccountIdByBussinespartnerId") == 1
+    assert api.paths.count("GetMeteringPointByAccountId") == 1
+    assert api.paths.count("Year") == 3